@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import pty
+import subprocess
+import sys
+import threading
+import time
+
+# This script measures tcore startup time against bare interpreter startup
+# and shows the slowest imports, as reported by `python -X importtime`.
+#
+# Usage: bench_startup.py [-n RUNS] [-t TOP] [tcore arguments...]
+#
+# By default, `tcore --help` and `tcore runenv true` are measured. Commands run
+# with stderr attached to a pseudo-terminal, as in interactive use: tcore
+# sets up colored output in that case.
+
+TCORE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tcore')
+
+# Runs the command with stderr attached to a pseudo-terminal, returns wall
+# time and stderr output
+def run_in_pty(cmd):
+    master, slave = pty.openpty()
+    output = []
+
+    # Terminal buffer is small, output must be drained while command runs
+    def drain():
+        while True:
+            try:
+                chunk = os.read(master, 65536)
+            except OSError:
+                break
+            if not chunk:
+                break
+            output.append(chunk)
+
+    reader = threading.Thread(target = drain)
+    reader.start()
+
+    start = time.monotonic()
+    subprocess.run(cmd, stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, stderr = slave)
+    elapsed = time.monotonic() - start
+
+    os.close(slave)
+    reader.join()
+    os.close(master)
+
+    return elapsed, b''.join(output).decode(errors = 'replace').replace('\r\n', '\n')
+
+# Runs the command several times, returns best wall time and stderr of that run
+def measure(cmd, runs):
+    best = None
+    best_err = ''
+
+    for _ in range(runs):
+        elapsed, err = run_in_pty(cmd)
+
+        if best is None or elapsed < best:
+            best = elapsed
+            best_err = err
+
+    return best, best_err
+
+# Parses `-X importtime` output, returns (self us, cumulative us, module) list
+# of top-level imports
+def parse_importtime(output):
+    imports = []
+
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+
+        name = fields[2].rstrip()
+        # Nested imports are indented, only top-level ones are interesting
+        if name.startswith('  '):
+            continue
+
+        imports.append((int(fields[0]), int(fields[1]), name.strip()))
+
+    return imports
+
+parser = argparse.ArgumentParser(description = 'Measure tcore startup time')
+parser.add_argument('-n', '--runs', type = int, default = 10,
+    help = 'Number of runs, best one is reported. Default is 10.')
+parser.add_argument('-t', '--top', type = int, default = 10,
+    help = 'Number of slowest imports to show. Default is 10.')
+parser.add_argument('tcore_args', nargs = argparse.REMAINDER,
+    help = 'Arguments passed to tcore. Default is --help, then runenv true.')
+
+args = parser.parse_args()
+commands = [ args.tcore_args ] if args.tcore_args else [ [ '--help' ], [ 'runenv', 'true' ] ]
+
+floor, _ = measure([ sys.executable, '-c', 'pass' ], args.runs)
+print('interpreter startup: {:8.1f} ms'.format(floor * 1000))
+
+for tcore_args in commands:
+    total, _ = measure([ sys.executable, TCORE ] + tcore_args, args.runs)
+    _, importtime = measure([ sys.executable, '-X', 'importtime', TCORE ] + tcore_args, 1)
+
+    print('\ntcore {}: {:8.1f} ms ({:+.1f} ms)'.format(' '.join(tcore_args),
+        total * 1000, (total - floor) * 1000))
+
+    print('slowest top-level imports (cumulative, ms):')
+    for self_us, cumulative_us, name in sorted(parse_importtime(importtime),
+            key = lambda i: i[1], reverse = True)[:args.top]:
+        print('{:8.1f}  {}'.format(cumulative_us / 1000, name))
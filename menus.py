@@ -6,12 +6,15 @@ import npyscreen, curses
 import re
 import sys
 import abc
-import copy
 import sre_yield_mod
 import os
 import collections
+import collections.abc
 import textwrap
 import logging
+import hashlib
+import operator
+import ast
 
 logger = logging.getLogger('tcore_configure')
 logger.setLevel(logging.DEBUG)
@@ -29,6 +32,347 @@ def natural_sort_key(s, _nsre=re.compile('([0-9]+)')):
     return [int(text) if text.isdigit() else text.lower()
             for text in re.split(_nsre, s)]
 
+# Splits "depends" expression into path, operator and right-hand side.
+# Returns None if expression is malformed.
+def parse_depends(depends_str):
+    s=re.search(r'(.*?)\s+(==|!=|>=|<=|>|<)\s+(.*)', depends_str)
+    if not s:
+        return None
+
+    return [ s[1], s[2], s[3] ]
+
+# Operators allowed in "depends" expressions
+depends_operators = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>=': operator.ge,
+    '<=': operator.le,
+    '>': operator.gt,
+    '<': operator.lt,
+}
+
+# Compiles parsed "depends" expression (see parse_depends()) into a function
+# that accepts output configuration and current container ID. Function
+# returns True if dependency is satisfied.
+def compile_depends(parsed):
+    def never(output_cfg, current_container):
+        return False
+
+    if not parsed:
+        return never
+
+    path, op, rhs = parsed
+
+    try:
+        literal = ast.literal_eval(rhs.strip())
+    except (ValueError, SyntaxError):
+        logger.debug('malformed dependency value: {}'.format(rhs))
+        return never
+
+    compare = depends_operators[op]
+
+    # Absolute path is split only once
+    keys = engine.get_json_keys(path) if path[0] == '/' else None
+
+    def evaluate(output_cfg, current_container):
+        val = output_cfg
+        try:
+            for it in keys or engine.get_json_keys(current_container + path):
+                val = val[it]
+
+            return bool(compare(val, literal))
+        except (KeyError, IndexError, TypeError):
+            # No value yet or it cannot be compared
+            return False
+
+    return evaluate
+
+# Expands enum values, given as a pattern, to a sorted list
+def expand_enum_values(pattern):
+    values = list(sre_yield_mod.AllStrings(pattern))
+    return sorted(values, key=natural_sort_key)
+
+#-------------------------------------------------------------------------------
+
+# Copy-on-write view of a mapping.
+#
+# Base mapping is never modified: changes are kept in the view itself, deleted
+# keys are remembered as tombstones. Nested mappings are wrapped into views
+# lazily, on first access. This allows many items to share a single schema
+# fragment, paying only for their own modifications.
+class overlay_dict(collections.abc.MutableMapping):
+    def __init__(self, base):
+        self.base = base
+        self.own = {}
+        self.tombstones = set()
+
+    def __getitem__(self, key):
+        if key in self.own:
+            return self.own[key]
+        if key in self.tombstones:
+            raise KeyError(key)
+
+        v = self.base[key]
+        if isinstance(v, collections.abc.Mapping):
+            # Nested view must persist, to keep its modifications
+            v = overlay_dict(v)
+            self.own[key] = v
+
+        return v
+
+    def __setitem__(self, key, value):
+        self.own[key] = value
+        self.tombstones.discard(key)
+
+    def __delitem__(self, key):
+        if not key in self:
+            raise KeyError(key)
+
+        self.own.pop(key, None)
+        if key in self.base:
+            self.tombstones.add(key)
+
+    def __contains__(self, key):
+        return key in self.own or (key in self.base and not key in self.tombstones)
+
+    def __iter__(self):
+        for key in self.base:
+            if not key in self.tombstones:
+                yield key
+
+        for key in self.own:
+            if not key in self.base:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return 'overlay_dict({!r})'.format(dict(self.items()))
+
+# Cache of parsed include files, keyed by path and modification time.
+# Every include gets its own copy-on-write view of the cached fragment.
+class include_cache:
+    def __init__(self, compiled_includes = {}):
+        self.fragments = {}
+        # Includes from compiled schema, see schema_cache class
+        self.compiled_includes = compiled_includes
+        self.hits = 0
+        self.misses = 0
+
+    # Gets view of the included file
+    def get(self, path):
+        key = (path, os.stat(path).st_mtime)
+
+        if key in self.fragments:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if path in self.compiled_includes:
+                # Compiled schema is validated when loaded
+                self.fragments[key] = self.compiled_includes[path]
+            else:
+                with open(path, 'r') as f:
+                    self.fragments[key] = json.load(f)
+
+        return overlay_dict(self.fragments[key])
+
+# Matcher of table specializations: `items-<pattern>` keys, which apply to
+# selected table values matching the pattern (in terms of re.search()).
+#
+# Literal patterns, like `items-PA0`, are placed in a trie, so all of them are
+# matched in one pass over the value. Other patterns are compiled once.
+class items_matcher:
+    def __init__(self, table_params):
+        self.keys = []
+        self.trie = {}
+        self.regexes = []
+
+        for k in table_params:
+            if not k.startswith('items-'):
+                continue
+
+            pattern = k[6:]
+            n = len(self.keys)
+            self.keys.append(k)
+
+            if re.escape(pattern) == pattern:
+                node = self.trie
+                for c in pattern:
+                    node = node.setdefault(c, {})
+                # Terminal marker can't clash with characters
+                node.setdefault(None, []).append(n)
+            else:
+                self.regexes.append((n, re.compile(pattern)))
+
+    # Gets keys of specializations applicable to the value, in original order
+    def match(self, val):
+        matched = set()
+
+        # Literal pattern is found anywhere in the value, as re.search() does
+        for start in range(len(val) + 1):
+            node = self.trie
+            matched.update(node.get(None, []))
+
+            for c in val[start:]:
+                node = node.get(c)
+                if node is None:
+                    break
+                matched.update(node.get(None, []))
+
+        for n, regex in self.regexes:
+            if regex.search(val):
+                matched.add(n)
+
+        return [ self.keys[n] for n in sorted(matched) ]
+
+#-------------------------------------------------------------------------------
+
+# Compiled configuration schema, cached on disk.
+#
+# Compiled schema holds everything the engine would otherwise compute on every
+# start: all include files (resolved by path), parsed dependencies and
+# expanded enum values. Cache is valid as long as none of the schema files is
+# changed. Missing include files are remembered too, so the cache is
+# invalidated once they appear.
+class schema_cache:
+    FORMAT_VERSION = 2
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    # Gets cache file path for the given root schema
+    def get_cache_path(self, schema_path):
+        key = hashlib.sha1(os.path.abspath(schema_path).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json')
+
+    # Gets file state, used to check if file is changed
+    @staticmethod
+    def get_file_state(path):
+        st = os.stat(path)
+        with open(path, 'rb') as f:
+            sha = hashlib.sha1(f.read()).hexdigest()
+
+        return { 'mtime': st.st_mtime, 'size': st.st_size, 'sha1': sha }
+
+    # Checks that file is not changed since compilation. State is None
+    # if file was missing.
+    @staticmethod
+    def is_file_unchanged(path, state):
+        if state is None:
+            return not os.path.exists(path)
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+
+        if st.st_mtime == state['mtime'] and st.st_size == state['size']:
+            return True
+
+        # File could be touched without changes, e.g. by git checkout
+        return st.st_size == state['size'] \
+            and schema_cache.get_file_state(path)['sha1'] == state['sha1']
+
+    # Loads compiled schema. Returns None if there is no valid cache.
+    def load(self, schema_path):
+        schema_path = os.path.abspath(schema_path)
+        cache_path = self.get_cache_path(schema_path)
+
+        if not os.path.isfile(cache_path):
+            return None
+
+        with open(cache_path, 'r') as f:
+            compiled = json.load(f)
+
+        if compiled.get('version') != self.FORMAT_VERSION \
+                or compiled.get('schema_path') != schema_path:
+            return None
+
+        for path, state in compiled['files'].items():
+            if not self.is_file_unchanged(path, state):
+                logger.debug('schema file changed: {}'.format(path))
+                return None
+
+        logger.debug('using compiled schema: {}'.format(cache_path))
+        return compiled
+
+    # Compiles schema and saves it into the cache. Returns compiled schema.
+    def compile(self, schema_path):
+        schema_path = os.path.abspath(schema_path)
+        schema_dir = os.path.dirname(schema_path)
+
+        compiled = {
+            'version': self.FORMAT_VERSION,
+            'schema_path': schema_path,
+            'files': {},
+            'includes': {},
+            'depends': {},
+            'enum_values': {},
+        }
+
+        # Walks schema object, collecting everything that can be precomputed
+        def walk(obj, src_path):
+            for k, v in obj.items():
+                if not isinstance(v, dict):
+                    continue
+
+                if isinstance(v.get('depends_on'), str):
+                    depends_str = v['depends_on']
+                    compiled['depends'][depends_str] = parse_depends(depends_str)
+
+                if v.get('type') == 'enum' and 'values' in v and not isinstance(v['values'], list):
+                    if not v['values'] in compiled['enum_values']:
+                        compiled['enum_values'][v['values']] = expand_enum_values(v['values'])
+
+                if k.startswith('include-') and 'ref' in v:
+                    # Same rules as in the engine: relative includes are
+                    # resolved against a file they are found in
+                    if v['ref'][0] != '/':
+                        path = os.path.normpath(os.path.dirname(src_path) + '/' + v['ref'])
+                    else:
+                        path = os.path.normpath(schema_dir + '/' + v['ref'])
+
+                    load_file(path)
+
+                walk(v, src_path)
+
+        # Loads schema file, if not loaded yet
+        def load_file(path):
+            if path in compiled['files']:
+                return
+
+            # Include could be inactive, thus its file is not required to
+            # exist. It is resolved by the engine then, if ever needed.
+            if path != schema_path and not os.path.isfile(path):
+                compiled['files'][path] = None
+                return
+
+            compiled['files'][path] = self.get_file_state(path)
+
+            with open(path, 'r') as f:
+                data = json.load(f)
+
+            if path != schema_path:
+                compiled['includes'][path] = data
+            else:
+                compiled['schema'] = data
+
+            walk(data, path)
+
+        load_file(schema_path)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_path = self.get_cache_path(schema_path)
+
+        # Compact representation, it is not intended to be read by humans
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump(compiled, f, separators=(',', ':'))
+        os.replace(cache_path + '.tmp', cache_path)
+
+        logger.debug('schema compiled into: {}'.format(cache_path))
+        return compiled
+
 #-------------------------------------------------------------------------------
 
 class abstract_ui(abc.ABC):
@@ -56,16 +400,56 @@ class abstract_ui(abc.ABC):
     def delete_config(self, menu_id, cfg_id):
         pass
 
+    # Called once after a batch of update_config() calls for the menu
+    def update_menu(self, menu_id):
+        pass
+
 class engine:
-    def __init__(self, ui_instance, schema_path, output_cfg = {}):
+    def __init__(self, ui_instance, schema_path, output_cfg = {}, schema_cache = None):
         schema_path = os.path.abspath(schema_path)
-        fl = open(schema_path, 'r')
         self.ui_instance = ui_instance
         self.items_data = {}
-        self.config_params = json.load(fl)
         self.output_cfg = output_cfg
         self.schema_path = schema_path
 
+        # Compiled schema is used if available, see schema_cache class
+        compiled = None
+        if schema_cache:
+            compiled = schema_cache.load(schema_path) or schema_cache.compile(schema_path)
+
+        if compiled:
+            self.config_params = compiled['schema']
+            self.includes = include_cache(compiled['includes'])
+            self.parsed_depends = compiled['depends']
+            self.enum_values = compiled['enum_values']
+        else:
+            with open(schema_path, 'r') as fl:
+                self.config_params = json.load(fl)
+            self.includes = include_cache()
+            self.parsed_depends = {}
+            self.enum_values = {}
+
+        # Compiled "depends" expressions, keyed by expression string
+        self.compiled_depends = {}
+
+        # Configuration class index: which configs provide values of a class
+        # (config-class) and which consume them (values-from). Kept in sync
+        # with items_data, see link_config() and remove_item()
+        self.class_providers = {}
+        self.class_consumers = {}
+
+        # Links (provider, dependee) which values must be propagated,
+        # see propagate_changes()
+        self.dirty_links = {}
+
+        # Items to re-evaluate when a value changes: output path (as a tuple
+        # of keys) to (menu ID, item key) pairs, see add_reverse_depends()
+        self.reverse_depends = {}
+
+        # Items created or deleted, which dependents are not yet re-evaluated.
+        # See process_changed_items().
+        self.changed_items = {}
+
         root_menu_id = '/'
         self.ui_instance.set_engine(self)
 
@@ -79,16 +463,14 @@ class engine:
 
         self.ui_instance.create_menu(None, root_menu_id, 'Welcome to theCore')
         self.process_menu(None, root_menu_id, self.config_params, self.output_cfg)
+        self.process_changed_items()
+        self.propagate_changes()
 
     def on_config_change(self, menu_id, cfg_id, **kwargs):
         if cfg_id in self.items_data:
             p_menu = self.items_data[menu_id]['p_menu']
             menu_params = self.items_data[menu_id]['data']
-            normalized_name = self.items_data[menu_id]['name']
-
-            # If no name present - dealing with top-level menu
-            output_obj = self.items_data[menu_id]['container'][normalized_name] \
-                if normalized_name else self.items_data[menu_id]['container']
+            output_obj = self.get_menu_output(menu_id)
             v = self.items_data[cfg_id]
 
             if menu_id == v['menu']:
@@ -99,13 +481,90 @@ class engine:
                         selector_id=cfg_id, selector_data=v, menu_id=menu_id,
                         menu_params=menu_params, src_cfg_name=src_cfg_name)
 
+                # Dependees must be updated only if the value is indeed changed
+                if 'class' in v and v['container'].get(src_cfg_name) != kwargs['value']:
+                    self.mark_dirty(cfg_id, self.get_dependees(cfg_id))
+
                 v['container'][src_cfg_name] = kwargs['value']
 
-                # Re-calculate and update menu accordingly
-                self.process_menu(p_menu, menu_id, menu_params, output_obj)
-                self.rebuild_config_links()
+                # Re-calculate and update menu accordingly. Selector changes
+                # menu contents, so the whole menu is processed. Otherwise,
+                # only items depending on the changed value are.
+                if v['item_type'] == 'selector':
+                    self.process_menu(p_menu, menu_id, menu_params, output_obj)
+                else:
+                    self.changed_items[cfg_id] = None
+                self.process_changed_items()
                 # Resulting
-                self.update_linked_configs(cfg_id)
+                self.propagate_changes()
+
+    # Re-evaluates items depending on changed items. Items created or
+    # deleted meanwhile are changes too, their dependents are re-evaluated
+    # until nothing changes.
+    def process_changed_items(self):
+        # Every item is evaluated once, so circular dependencies can't loop
+        evaluated = set()
+
+        while self.changed_items:
+            item_id = next(iter(self.changed_items))
+            del self.changed_items[item_id]
+
+            dependent = self.get_reverse_depends(item_id)
+            # Menus with includes or tables are processed entirely
+            full_menus = {}
+
+            for menu_id, k in dependent:
+                if (menu_id, k) in evaluated:
+                    continue
+
+                # Menu could be deleted while processing previous items
+                if not self.is_menu_alive(menu_id):
+                    continue
+
+                menu_params = self.items_data[menu_id]['data']
+                v = menu_params.get(k)
+
+                if not isinstance(v, collections.abc.Mapping):
+                    continue
+                elif k.startswith('config-') or k.startswith('menu-'):
+                    evaluated.add((menu_id, k))
+                    self.process_item(self.items_data[menu_id]['p_menu'], menu_id,
+                        self.get_menu_output(menu_id), k, v)
+                elif k.startswith('include-') or k.startswith('table-'):
+                    evaluated.add((menu_id, k))
+                    full_menus[menu_id] = None
+
+            for menu_id in full_menus:
+                if self.is_menu_alive(menu_id):
+                    self.process_menu(self.items_data[menu_id]['p_menu'], menu_id,
+                        self.items_data[menu_id]['data'], self.get_menu_output(menu_id))
+
+    # Checks if menu is not deleted. Sub-menus of a deleted menu are kept
+    # in items data, but lose their internal IDs.
+    def is_menu_alive(self, menu_id):
+        if not menu_id in self.items_data:
+            return False
+
+        menu_data = self.items_data[menu_id]
+        # Root menu is never deleted
+        return menu_data['p_menu'] is None or menu_data['data'].get('internal_id') == menu_id
+
+    # Gets items depending on the given item. Items depending on anything
+    # inside a menu depend on the menu itself.
+    def get_reverse_depends(self, item_id):
+        keys = tuple(self.get_json_keys(item_id))
+
+        if not item_id.endswith('/'):
+            return list(self.reverse_depends.get(keys, {}))
+
+        # Menu ID ends with a slash, thus the last key is empty
+        keys = keys[:-1]
+        dependent = {}
+        for path, items in self.reverse_depends.items():
+            if path[:len(keys)] == keys:
+                dependent.update(items)
+
+        return list(dependent)
 
     # Manages configurations grouped in tables
     def handle_table_configurations(self, new_selector_values, menu_id, selector_id, selector_data, menu_params, src_cfg_name):
@@ -132,28 +591,30 @@ class engine:
 
         for val in values:
             pseudo_name = 'menu-{}'.format(val)
-            pseudo_data = {
-                'description': '{} configuration'.format(val),
-            }
             new_menu_id = '{}{}-pseudo/'.format(menu_id, pseudo_name)
 
             if val in already_created:
                 # Already created
                 continue
 
-            # Inject rest of the configuration data. Inject by
-            # deepcopy is required to avoid cross-talk between entries
-            # in a table
-            pseudo_data.update(copy.deepcopy(menu_params[src_cfg_name]['items']))
+            # Layers of the configuration data, the last one takes precedence
+            layers = [
+                { 'description': '{} configuration'.format(val) },
+                menu_params[src_cfg_name]['items'],
+            ]
 
             # There can be a configuration, depended on selected key.
-            # TODO: use regex instead of simple string comparsion
-            for k, v in menu_params[src_cfg_name].items():
-                if k.startswith('items-'):
-                    pattern = k[6:]
-                    if re.search(pattern, val):
-                        dependent_items = 'items-{}'.format(val)
-                        pseudo_data.update(copy.deepcopy(v))
+            # Matcher is built once per table.
+            if not 'items_matcher' in selector_data:
+                selector_data['items_matcher'] = items_matcher(menu_params[src_cfg_name])
+
+            for k in selector_data['items_matcher'].match(val):
+                layers.append(menu_params[src_cfg_name][k])
+
+            # Layers are shared between all entries in a table. To avoid
+            # cross-talk between entries, every entry keeps its own
+            # modifications in a copy-on-write view.
+            pseudo_data = overlay_dict(collections.ChainMap(*reversed(layers)))
 
             # Delete duplicated key item. It resides both "outside"
             # and "inside". Delete from "inside"
@@ -194,11 +655,11 @@ class engine:
             self.process_menu(menu_id, new_menu_id, pseudo_data,
                 selector_data['container'][pseudo_name])
 
-            self.rebuild_config_links()
-            self.update_all_linked_configs()
-
     # Creates configuration
     def handle_config_creation(self, p_menu_id, menu_id, new_cfg_id, name, data, item_type, container, selected):
+        # Config can be re-created, forget its old links
+        self.unlink_config(new_cfg_id)
+
         self.items_data[new_cfg_id] = {
             'item_type': item_type,
             'name': name,
@@ -218,6 +679,14 @@ class engine:
         if 'values-from' in data:
             self.items_data[new_cfg_id]['values_from'] = data['values-from'].split(',')
 
+        self.link_config(new_cfg_id)
+
+        # New config must receive values from its providers, and new
+        # provider must push its values to dependees
+        for src_cfg_id in self.get_dependers(new_cfg_id):
+            self.mark_dirty(src_cfg_id, [ new_cfg_id ])
+        self.mark_dirty(new_cfg_id, self.get_dependees(new_cfg_id))
+
         logger.debug('creating cfg: {}'.format(new_cfg_id))
 
         type = data['type']
@@ -237,8 +706,13 @@ class engine:
                 values = data['values']
                 # If value specification is not a list, treat it as a pattern
                 if not isinstance(values, list):
-                    values = list(sre_yield_mod.AllStrings(values))
-                    values = sorted(values, key=natural_sort_key)
+                    if not values in self.enum_values:
+                        self.enum_values[values] = expand_enum_values(values)
+                    values = self.enum_values[values]
+
+                # Values are shared with schema and other configs,
+                # UI gets its own copy
+                values = list(values)
 
             self.ui_instance.create_config(menu_id, new_cfg_id,
                 'enum', description=data['description'],
@@ -260,107 +734,159 @@ class engine:
                 long_description=long_description,
                 selected=selected)
 
-    # Process configuration classes and update configuration data with
-    # correct dependee references
-    def rebuild_config_links(self):
-        src_cfgs = { }
-        dest_cfgs = { }
-
-        for k, v in self.items_data.items():
-            if 'class' in v:
-                v['dependees'] = []
-                src_cfgs[k] = v
-            if 'values_from' in v:
-                v['dependers'] = []
-                dest_cfgs[k] = v
-
-        for src, src_data in src_cfgs.items():
-            for dest, dest_data in dest_cfgs.items():
-                # Find a match between a class and a value selector
-                if not set(src_data['class']).isdisjoint(dest_data['values_from']):
-                    # Create a link
-                    if not dest in src_data['dependees']:
-                        src_data['dependees'] += [dest]
-                    if not src in dest_data['dependers']:
-                        dest_data['dependers'] += [src]
-
-    # Updates all linked configurations
-    def update_all_linked_configs(self):
-        for k in self.items_data:
-            self.update_linked_configs(k)
-
-    # Updates linked configurations from given source config
-    def update_linked_configs(self, src_cfg_id):
-        if 'dependees' in self.items_data[src_cfg_id]:
-            deps = self.items_data[src_cfg_id]['dependees']
+    # Adds configuration into the class index
+    def link_config(self, cfg_id):
+        v = self.items_data[cfg_id]
+
+        # Dicts are used as ordered sets
+        for c in v.get('class', []):
+            self.class_providers.setdefault(c, {})[cfg_id] = None
+        for c in v.get('values_from', []):
+            self.class_consumers.setdefault(c, {})[cfg_id] = None
+
+    # Removes configuration from the class index
+    def unlink_config(self, cfg_id):
+        v = self.items_data.get(cfg_id)
+        if not v:
+            return
+
+        for c in v.get('class', []):
+            self.class_providers.get(c, {}).pop(cfg_id, None)
+        for c in v.get('values_from', []):
+            self.class_consumers.get(c, {}).pop(cfg_id, None)
+
+    # Removes item, keeping class index consistent
+    def remove_item(self, item_id):
+        if item_id in self.items_data:
+            # Dependees lose values of the removed provider, so values of
+            # remaining providers must be propagated again
+            for d in self.get_dependees(item_id):
+                for src_cfg_id in self.get_dependers(d):
+                    if src_cfg_id != item_id and d != item_id:
+                        self.mark_dirty(src_cfg_id, [ d ])
+
+        self.dirty_links = { link: None for link in self.dirty_links if not item_id in link }
+        self.unlink_config(item_id)
+        return self.items_data.pop(item_id, None)
+
+    # Gets configurations which values are taken from the given config
+    def get_dependees(self, src_cfg_id):
+        deps = {}
+        for c in self.items_data[src_cfg_id].get('class', []):
+            deps.update(self.class_consumers.get(c, {}))
+
+        return list(deps)
+
+    # Gets configurations which provide values for the given config
+    def get_dependers(self, dest_cfg_id):
+        deps = {}
+        for c in self.items_data[dest_cfg_id].get('values_from', []):
+            deps.update(self.class_providers.get(c, {}))
+
+        return list(deps)
+
+    # Marks links between provider and its dependees, values must be propagated
+    def mark_dirty(self, src_cfg_id, dependees):
+        for d in dependees:
+            self.dirty_links[(src_cfg_id, d)] = None
+
+    # Propagates values through dirty links. Links are processed in topological
+    # order: dependee that is also a provider is updated before its own
+    # dependees. Every affected menu is notified once, after all its configs
+    # are updated.
+    def propagate_changes(self):
+        updated_menus = {}
+
+        while self.dirty_links:
+            # Pick a link which provider is not going to be updated.
+            # In case of a cycle, any will do.
+            pending = set(d for src, d in self.dirty_links)
+            src_cfg_id, d = next((link for link in self.dirty_links if not link[0] in pending),
+                next(iter(self.dirty_links)))
+            del self.dirty_links[(src_cfg_id, d)]
+
             menu_id = self.items_data[src_cfg_id]['menu']
+            d_menu_id = self.items_data[d]['menu']
+            clear_data = self.ui_instance.update_config(d_menu_id, d,
+                depender={'menu_id': menu_id, 'cfg_id': src_cfg_id})
+
+            # Clear output data, in case if value lies out of domain.
+            # User will be forced to enter new values.
+            if clear_data:
+                name = self.items_data[d]['name']
+                self.items_data[d]['container'][name] = []
+
+                # Cleared value is a change, too
+                self.mark_dirty(d, [ c for c in self.get_dependees(d) if c != d ])
+
+            updated_menus[d_menu_id] = None
+
+        for menu_id in updated_menus:
+            self.ui_instance.update_menu(menu_id)
+
+    # Possible ways to handle items, see get_decision()
+    create_item = 0
+    skip_item = 1
+    delete_item = 2
+
+    # Gets decision on what do with the item: create, delete, or skip
+    def get_decision(self, menu_id, k, v):
+        # If no ID is assigned - no config/menu is created yet
+        created = 'internal_id' in v
+
+        # Is item has a dependency?
+        if 'depends_on' in v:
+            self.add_reverse_depends(v['depends_on'], menu_id, k)
+
+            # Is dependency satisfied?
+            if self.eval_depends(v['depends_on'], menu_id):
+                # New item should be created, if not yet
+                return self.skip_item if created else self.create_item
+            else:
+                # Dependency is not satisfied - item shouldn't
+                # be displayed. Item must be deleted, if present.
+                return self.delete_item if created else self.skip_item
+
+        # Item is dependless. Meaning should be displayed
+        # no matter what.
+        return self.skip_item if created else self.create_item
+
+    # Remembers that item depends on a value, so the item is re-evaluated
+    # when the value changes. See on_config_change().
+    def add_reverse_depends(self, depends_str, menu_id, k):
+        if not isinstance(depends_str, str):
+            return
+
+        if not depends_str in self.parsed_depends:
+            self.parsed_depends[depends_str] = parse_depends(depends_str)
 
-            # Every dependee must be updated.
-            for d in deps:
-                d_menu_id = self.items_data[d]['menu']
-                clear_data = self.ui_instance.update_config(d_menu_id, d,
-                    depender={'menu_id': menu_id, 'cfg_id': src_cfg_id})
+        parsed = self.parsed_depends[depends_str]
+        if not parsed:
+            return
 
-                # Clear output data, in case if value lies out of domain.
-                # User will be forced to enter new values.
-                if clear_data:
-                    name = self.items_data[d]['name']
-                    self.items_data[d]['container'][name] = []
+        path = parsed[0] if parsed[0][0] == '/' else menu_id + parsed[0]
+        key = tuple(self.get_json_keys(path))
+        self.reverse_depends.setdefault(key, {})[(menu_id, k)] = None
+
+    # Gets output object of the menu
+    def get_menu_output(self, menu_id):
+        normalized_name = self.items_data[menu_id]['name']
+
+        # If no name present - dealing with top-level menu
+        return self.items_data[menu_id]['container'][normalized_name] \
+            if normalized_name else self.items_data[menu_id]['container']
 
     # Processes menu, creating and deleting configurations when needed
     def process_menu(self, p_menu_id, menu_id, menu_params, output_obj):
-        # Internal helper to find item by normalized key
-        def is_created(name, data):
-            # If no ID is assigned - no config/menu is created yet
-            return 'internal_id' in data
-
         # Internal helper to check if output object was created or not
         def is_output_created(name, data):
             return name in output_obj
 
-        # Possible ways to handle items
-        create_item = 0
-        skip_item = 1
-        delete_item = 2
+        create_item = self.create_item
+        delete_item = self.delete_item
 
-        # Gets decision on what do with the item: create, delete, or skip
         def get_decision(k, v):
-            decision = None
-            # Is item has a dependency?
-            if 'depends_on' in v:
-                # Is dependency satisfied?
-                if self.eval_depends(v['depends_on'], menu_id):
-                    # Is item created?
-                    if is_created(k, v):
-                        # item is already created, nothing to do
-                        decision = skip_item
-                    else:
-                        # New item should be created
-                        decision = create_item
-                else:
-                    # Dependency is not satisfied - item shouldn't
-                    # be displayed.
-
-                    # Is item created?
-                    if is_created(k, v):
-                        # Item must be deleted, if present.
-                        decision = delete_item
-                    else:
-                        # No item present, nothing to delete
-                        decision = skip_item
-            else:
-                # Item is dependless. Meaning should be displayed
-                # no matter what.
-
-                # Is item created?
-                if is_created(k, v):
-                    # item is already created, nothing to do
-                    decision = skip_item
-                else:
-                    # New item should be created
-                    decision = create_item
-
-            return decision
+            return self.get_decision(menu_id, k, v)
 
         # Pre-process include files.
         def preprocess_includes(params):
@@ -392,8 +918,9 @@ class engine:
                         # To notify that include is already resolved
                         v['internal_id'] = inc_id
 
-                        # Add dict object after the incldue
-                        inc = json.load(open(path, 'r'))
+                        # Add dict object after the incldue. Included items are
+                        # modified in place, so a copy-on-write view is used.
+                        inc = self.includes.get(path)
 
                         # Every menu or include directive must be aware of its origin
                         def set_origin(obj, origin):
@@ -401,7 +928,7 @@ class engine:
                                 if k.startswith('menu-') or k.startswith('include-'):
                                     v['internal_origin'] = origin
 
-                                if isinstance(v, dict):
+                                if isinstance(v, collections.abc.Mapping):
                                     set_origin(v, origin)
 
                         set_origin(inc, inc_id)
@@ -467,97 +994,105 @@ class engine:
             if not k.startswith('config-') and not k.startswith('menu-'):
                 continue # Skip not interested fields
 
-            decision = get_decision(k, v)
-
-            if k.startswith('config-'):
-                # Create, skip, delete config
-
-                if decision == create_item:
-                    selected = None
-                    if not is_output_created(k, v):
-                        # Initialize empty config, later UI will publish
-                        # changes to it
-                        output_obj[k] = {}
-
-                        # Is there any default value present? If so - use it
-                        if 'default' in v:
-                            selected = v['default']
-                            output_obj[k] = selected
-
-                    else:
-                        selected = output_obj[k]
-
-                    # No backslash at the end means it is a config
-                    new_config_id = menu_id + k
-
-                    self.handle_config_creation(p_menu_id, menu_id, new_config_id,
-                        k, v, 'config', output_obj, selected)
-
-                elif decision == delete_item:
-                    # Configuration must be deleted, if present.
-                    self.ui_instance.delete_config(menu_id, v['internal_id'])
-                    self.items_data.pop(v['internal_id'], None)
-                    v.pop('internal_id', None)
-                    output_obj.pop(k, None)
-
-                elif decision == skip_item:
-                    pass # Nothing to do
-
-            elif k.startswith('menu-'):
-                # Create, skip, delete menu
-                if decision == create_item:
-                    long_description = v['long-description'] if 'long-description' in v else None
-                    new_menu_id = menu_id + k + '/'
-                    self.ui_instance.create_menu(menu_id, new_menu_id,
-                        description=v['description'], long_description=long_description)
-
-                    if not is_output_created(k, v):
-                        output_obj[k] = {}
-
-                    self.items_data[new_menu_id] = {
-                        'item_type': 'menu',
-                        'name': k,
-                        'data': v,
-                        'p_menu': menu_id,
-                        'container': output_obj
-                    }
-
-                    # Inject the internal menu ID into the source config,
-                    # for convenience
-                    v['internal_id'] = new_menu_id
-
-                    self.process_menu(menu_id, new_menu_id, v, output_obj[k])
+            self.process_item(p_menu_id, menu_id, output_obj, k, v)
 
-                elif decision == delete_item:
-                    # Delete menu first
-                    target_menu_id = v['internal_id']
-                    target_container = self.items_data[target_menu_id]['container']
-                    target_container.pop(k, None)
+    # Creates, deletes or skips single config or menu item
+    def process_item(self, p_menu_id, menu_id, output_obj, k, v):
+        decision = self.get_decision(menu_id, k, v)
 
-                    self.ui_instance.delete_menu(target_menu_id)
-                    self.items_data.pop(target_menu_id, None)
+        if k.startswith('config-'):
+            # Create, skip, delete config
 
-                    # TODO: sanitize sub-menus (challenge: root menu don't have p_menu_id)
+            if decision == self.create_item:
+                selected = None
+                if not k in output_obj:
+                    # Initialize empty config, later UI will publish
+                    # changes to it
+                    output_obj[k] = {}
 
-                    # Delete all configs' internal IDs, to prevent them
-                    # to be treated as created
-                    def delete_internal_id(val):
-                        val.pop('internal_id', None)
-                        for nested in val.values():
-                            if isinstance(nested, dict):
-                                delete_internal_id(nested)
+                    # Is there any default value present? If so - use it
+                    if 'default' in v:
+                        selected = v['default']
+                        output_obj[k] = selected
 
-                    delete_internal_id(v)
-
-                    # Sanitize all configs: delete configuration without menu
-                    to_delete = [ item_id for item_id, item_v in self.items_data.items() \
-                        if item_v['item_type'] == 'config' and not item_v['menu'] in self.items_data ]
-
-                    for k in to_delete:
-                        del self.items_data[k]
-
-                elif decision == skip_item:
-                    pass # Nothing to do
+                else:
+                    selected = output_obj[k]
+
+                # No backslash at the end means it is a config
+                new_config_id = menu_id + k
+
+                self.handle_config_creation(p_menu_id, menu_id, new_config_id,
+                    k, v, 'config', output_obj, selected)
+                self.changed_items[new_config_id] = None
+
+            elif decision == self.delete_item:
+                # Configuration must be deleted, if present.
+                self.changed_items[v['internal_id']] = None
+                self.ui_instance.delete_config(menu_id, v['internal_id'])
+                self.remove_item(v['internal_id'])
+                v.pop('internal_id', None)
+                output_obj.pop(k, None)
+
+            elif decision == self.skip_item:
+                pass # Nothing to do
+
+        elif k.startswith('menu-'):
+            # Create, skip, delete menu
+            if decision == self.create_item:
+                long_description = v['long-description'] if 'long-description' in v else None
+                new_menu_id = menu_id + k + '/'
+                self.ui_instance.create_menu(menu_id, new_menu_id,
+                    description=v['description'], long_description=long_description)
+
+                if not k in output_obj:
+                    output_obj[k] = {}
+
+                self.items_data[new_menu_id] = {
+                    'item_type': 'menu',
+                    'name': k,
+                    'data': v,
+                    'p_menu': menu_id,
+                    'container': output_obj
+                }
+
+                # Inject the internal menu ID into the source config,
+                # for convenience
+                v['internal_id'] = new_menu_id
+                self.changed_items[new_menu_id] = None
+
+                self.process_menu(menu_id, new_menu_id, v, output_obj[k])
+
+            elif decision == self.delete_item:
+                # Delete menu first
+                target_menu_id = v['internal_id']
+                self.changed_items[target_menu_id] = None
+                target_container = self.items_data[target_menu_id]['container']
+                target_container.pop(k, None)
+
+                self.ui_instance.delete_menu(target_menu_id)
+                self.items_data.pop(target_menu_id, None)
+
+                # TODO: sanitize sub-menus (challenge: root menu don't have p_menu_id)
+
+                # Delete all configs' internal IDs, to prevent them
+                # to be treated as created
+                def delete_internal_id(val):
+                    val.pop('internal_id', None)
+                    for nested in val.values():
+                        if isinstance(nested, collections.abc.Mapping):
+                            delete_internal_id(nested)
+
+                delete_internal_id(v)
+
+                # Sanitize all configs: delete configuration without menu
+                to_delete = [ item_id for item_id, item_v in self.items_data.items() \
+                    if item_v['item_type'] == 'config' and not item_v['menu'] in self.items_data ]
+
+                for item_id in to_delete:
+                    self.remove_item(item_id)
+
+            elif decision == self.skip_item:
+                pass # Nothing to do
 
     # Gets output configuration
     def get_output(self):
@@ -565,52 +1100,52 @@ class engine:
         def sanitize(v):
             items = list(v.keys())
             for item in items:
-                if isinstance(v[item], dict):
+                if isinstance(v[item], collections.abc.Mapping):
                     sanitize(v[item])
 
                 # Delete item, if empty
-                if isinstance(v[item], collections.Iterable) and not any(v[item]):
+                if isinstance(v[item], collections.abc.Iterable) and not any(v[item]):
                     del v[item]
 
         sanitize(self.output_cfg)
 
+        logger.debug('include cache: {} hits, {} misses'.format(
+            self.includes.hits, self.includes.misses))
+
         return self.output_cfg
 
+    # Helper routine to split path into dict keys
+    @staticmethod
+    def get_json_keys(path):
+        # Pseudo menus are placed without suffix in output configuration
+        return [ it[:-7] if it.endswith('-pseudo') else it for it in path.split('/')[1:] ]
+
     # Helper routine to get dict value using path
     def get_json_val(self, dict_arg, path):
         val=dict_arg
-        for it in path.split('/')[1:]:
-            # Pseudo menus are placed without suffix in output configuration
-            if it.endswith('-pseudo'):
-                it = it[:-7]
-
+        for it in self.get_json_keys(path):
             val = val[it]
 
         return val
 
-    # Evaluates "depends" expression
+    # Evaluates "depends" expression. Expression is compiled once, then
+    # evaluated without any parsing.
     def eval_depends(self, depends_str, current_container):
-        try:
-            s=re.search(r'(.*?)\s+(==|!=|>=|<=|>|<)\s+(.*)', depends_str)
-            path = s[1]
-            if path[0] != '/':
-                path = current_container + path
-
-            logger.debug('resolving dependency: {} {} {}'.format(path, s[2], s[3]))
+        if not isinstance(depends_str, str):
+            return False
 
-            val=self.get_json_val(self.output_cfg, path)
+        evaluate = self.compiled_depends.get(depends_str)
 
-            logger.debug('got val: {}'.format(val))
+        if not evaluate:
+            if depends_str in self.parsed_depends:
+                parsed = self.parsed_depends[depends_str]
+            else:
+                parsed = parse_depends(depends_str)
 
-            # To let string be processed in eval() without errors,
-            # it should be captured in quotes
-            if type(val) is str:
-                val='\'' + val + '\''
+            evaluate = compile_depends(parsed)
+            self.compiled_depends[depends_str] = evaluate
 
-            expr=str(val) + s[2] + s[3]
-            return eval(expr)
-        except:
-            return False
+        return evaluate(self.output_cfg, current_container)
 
 #-------------------------------------------------------------------------------
 
@@ -777,7 +1312,7 @@ class npyscreen_form(npyscreen.ActionFormV2WithMenus):
 #-------------------------------------------------------------------------------
 
 class npyscreen_ui(abstract_ui):
-    def __init__(self, npyscreen_app, root_cfg_path, project_path):
+    def __init__(self, npyscreen_app, root_cfg_path, project_path, schema_cache=None):
         self.menu_forms = {}
         self.npyscreen_app = npyscreen_app
         self.engine = None
@@ -839,7 +1374,8 @@ class npyscreen_ui(abstract_ui):
             output_cfg = json.load(open(self.path, 'r'))
 
         self.create_menu(None, 'MAIN', 'theCore configurator')
-        self.engine = engine(self, schema_path=schema_path, output_cfg=output_cfg)
+        self.engine = engine(self, schema_path=schema_path, output_cfg=output_cfg,
+            schema_cache=schema_cache)
 
     def set_engine(self, engine):
         self.engine = engine
@@ -998,6 +1534,9 @@ class npyscreen_ui(abstract_ui):
 
         return False
 
+    def update_menu(self, menu_id):
+        self.update_form(menu_id)
+
     def delete_config(self, menu_id, cfg_id):
         fields = self.menu_forms[menu_id]['config_fields']
         if 'array-control-parent' in fields[cfg_id]:
@@ -1167,13 +1706,15 @@ class npyscreen_ui(abstract_ui):
 #-------------------------------------------------------------------------------
 
 class theCoreConfiguratorApp(npyscreen.NPSAppManaged):
-    def __init__(self, root_cfg_path, project_path, *args, **kwargs):
+    def __init__(self, root_cfg_path, project_path, *args, schema_cache=None, **kwargs):
         self.root_cfg_path = os.path.normpath(root_cfg_path)
         self.project_path = os.path.normpath(project_path)
+        self.schema_cache = schema_cache
         super().__init__(*args, **kwargs)
 
     def onStart(self):
-        self.ui = npyscreen_ui(self, self.root_cfg_path, self.project_path)
+        self.ui = npyscreen_ui(self, self.root_cfg_path, self.project_path,
+            schema_cache=self.schema_cache)
 
 #-------------------------------------------------------------------------------
 
@@ -12,6 +12,7 @@ setup(
   download_url = 'https://github.com/theCore-embedded/tcore_cli/archive/v0.2.3.tar.gz',
   keywords = ['embedded', 'cpp', 'c++', 'the_core'],
   classifiers = [],
-  install_requires = [ 'tabulate', 'requests', 'coloredlogs', 'npyscreen', ],
+  python_requires = '>=3.7',
+  install_requires = [ 'tabulate', 'requests', 'npyscreen', ],
   license = 'MPL'
 )
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import collections
+import copy
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import menus
+
+# UI that only records created and deleted items
+class recording_ui(menus.abstract_ui):
+    def __init__(self):
+        self.menus = set()
+        self.configs = set()
+
+    def set_engine(self, engine):
+        pass
+
+    def create_menu(self, p_menu_id, menu_id, description=None, long_description=None):
+        self.menus.add(menu_id)
+
+    def delete_menu(self, menu_id):
+        self.menus.discard(menu_id)
+
+    def create_config(self, menu_id, cfg_id, type, description, long_description=None, **kwargs):
+        self.configs.add(cfg_id)
+
+    def update_config(self, menu_id, cfg_id, depender=None, description=None, long_description=None, **kwargs):
+        return False
+
+    def delete_config(self, menu_id, cfg_id):
+        self.configs.discard(cfg_id)
+
+# Chain of dependencies: config-c depends on config-b, which depends on config-a
+chained_schema = {
+    'config-a': {
+        'type': 'enum',
+        'description': 'A',
+        'values': [ 'x', 'y' ],
+    },
+    'config-b': {
+        'type': 'enum',
+        'description': 'B',
+        'values': [ 'on', 'off' ],
+        'default': 'on',
+        'depends_on': "/config-a == 'y'",
+    },
+    'config-c': {
+        'type': 'string',
+        'description': 'C',
+        'depends_on': "/config-b == 'on'",
+    },
+}
+
+class test_dependent_items(unittest.TestCase):
+    def setUp(self):
+        fd, self.schema_path = tempfile.mkstemp(suffix = '.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(chained_schema, f)
+
+    def tearDown(self):
+        os.remove(self.schema_path)
+
+    def test_chained_creation(self):
+        ui = recording_ui()
+        output = {}
+        e = menus.engine(ui, self.schema_path, output)
+        self.assertEqual(ui.configs, { '/config-a' })
+
+        e.on_config_change('/', '/config-a', value = 'y')
+
+        self.assertEqual(ui.configs, { '/config-a', '/config-b', '/config-c' })
+        self.assertEqual(output['config-b'], 'on')
+        self.assertIn('config-c', output)
+
+    def test_chained_deletion(self):
+        ui = recording_ui()
+        output = { 'config-a': 'y', 'config-b': 'on', 'config-c': 'z' }
+        e = menus.engine(ui, self.schema_path, output)
+        self.assertEqual(ui.configs, { '/config-a', '/config-b', '/config-c' })
+
+        e.on_config_change('/', '/config-a', value = 'x')
+
+        self.assertEqual(ui.configs, { '/config-a' })
+        self.assertEqual(output, { 'config-a': 'x' })
+        self.assertNotIn('/config-c', e.items_data)
+
+# Specializations of table items, as they were matched before items_matcher
+def search_items(table_params, val):
+    return [ k for k in table_params if k.startswith('items-') and re.search(k[6:], val) ]
+
+class test_items_matcher(unittest.TestCase):
+    table_params = {
+        'type': 'table',
+        'items-PA1': {},
+        'items-PA10': {},
+        'items-PA': {},
+        'items-': {},
+        'items-PB[0-9]+': {},
+        'items-^PC1$': {},
+        'items-UART': {},
+        'items-.*2': {},
+        'items-A1': {},
+    }
+
+    def check(self, val):
+        matcher = menus.items_matcher(self.table_params)
+        self.assertEqual(matcher.match(val), search_items(self.table_params, val), val)
+
+    def test_prefix_patterns(self):
+        matcher = menus.items_matcher(self.table_params)
+        self.assertEqual(matcher.match('PA10'),
+            [ 'items-PA1', 'items-PA10', 'items-PA', 'items-', 'items-A1' ])
+        self.assertEqual(matcher.match('PA1'),
+            [ 'items-PA1', 'items-PA', 'items-', 'items-A1' ])
+
+    def test_known_values(self):
+        for val in [ '', 'PA1', 'PA10', 'PA2', 'PB12', 'PC1', 'PC10', 'UART1',
+                'USART2', 'xPA1x', 'A', 'P' ]:
+            self.check(val)
+
+    def test_random_values(self):
+        rng = random.Random(1)
+        for _ in range(1000):
+            self.check(''.join(rng.choice('PABC0125UART') for _ in range(rng.randrange(8))))
+
+    def test_no_items(self):
+        matcher = menus.items_matcher({ 'type': 'table' })
+        self.assertEqual(matcher.match('PA1'), [])
+
+class test_overlay_dict(unittest.TestCase):
+    def setUp(self):
+        self.base = {
+            'a': 1,
+            'b': { 'x': 1, 'y': { 'z': 2 } },
+            'c': [ 1, 2 ],
+        }
+        self.base_copy = copy.deepcopy(self.base)
+        self.overlay = menus.overlay_dict(self.base)
+
+    def tearDown(self):
+        self.assertEqual(self.base, self.base_copy)
+
+    def test_set(self):
+        self.overlay['a'] = 10
+        self.overlay['d'] = 4
+
+        self.assertEqual(self.overlay['a'], 10)
+        self.assertEqual(self.overlay['d'], 4)
+        self.assertEqual(list(self.overlay), [ 'a', 'b', 'c', 'd' ])
+        self.assertEqual(len(self.overlay), 4)
+
+    def test_delete(self):
+        del self.overlay['a']
+        self.overlay['d'] = 4
+        del self.overlay['d']
+
+        self.assertNotIn('a', self.overlay)
+        self.assertNotIn('d', self.overlay)
+        with self.assertRaises(KeyError):
+            self.overlay['a']
+        with self.assertRaises(KeyError):
+            del self.overlay['a']
+        with self.assertRaises(KeyError):
+            del self.overlay['missing']
+
+        self.assertEqual(list(self.overlay), [ 'b', 'c' ])
+        self.assertEqual(len(self.overlay), 2)
+
+    def test_set_after_delete(self):
+        del self.overlay['a']
+        self.overlay['a'] = 10
+
+        self.assertEqual(self.overlay['a'], 10)
+        self.assertEqual(list(self.overlay), [ 'a', 'b', 'c' ])
+
+    def test_nested(self):
+        nested = self.overlay['b']
+        nested['x'] = 10
+        del nested['y']['z']
+        nested['y']['w'] = 3
+
+        self.assertIs(self.overlay['b'], nested)
+        self.assertEqual(self.overlay['b']['x'], 10)
+        self.assertEqual(dict(self.overlay['b']['y']), { 'w': 3 })
+
+    def test_chain_map_base(self):
+        base = collections.ChainMap({ 'a': 1, 'b': 2 }, { 'b': 20, 'c': 30 })
+        base_order = list(base)
+        overlay = menus.overlay_dict(base)
+
+        overlay['b'] = 200
+        overlay['d'] = 4
+        del overlay['a']
+
+        self.assertEqual(list(overlay), [ k for k in base_order if k != 'a' ] + [ 'd' ])
+        self.assertEqual(overlay['b'], 200)
+        self.assertEqual(overlay['c'], 30)
+        self.assertEqual(len(overlay), 3)
+        self.assertEqual(base.maps, [ { 'a': 1, 'b': 2 }, { 'b': 20, 'c': 30 } ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+
+import importlib.machinery
+import importlib.util
+import json
+import os
+import logging
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    import tkinter
+except ImportError:
+    tkinter = None
+
+TCORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tcore')
+
+# Imports tcore script as a module. Command line is not parsed in that case.
+def load_tcore():
+    loader = importlib.machinery.SourceFileLoader('tcore', TCORE_PATH)
+    spec = importlib.util.spec_from_loader('tcore', loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+tcore = load_tcore()
+
+# Writes executable script
+def write_script(path, content):
+    with open(path, 'w') as fl:
+        fl.write(content)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+class test_nix_shell_env(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        bin_dir = self.tmp_dir + '/bin'
+        os.makedirs(bin_dir)
+
+        # Behaves like nix-shell: runs the command with temporary
+        # directories pointing to the directory deleted on exit
+        write_script(bin_dir + '/nix-shell', '''#!/bin/sh
+while [ "$1" != "--run" ]; do shift; done
+export TMPDIR=/tmp/nix-shell.deleted TEMPDIR=/tmp/nix-shell.deleted
+export TMP=/tmp/nix-shell.deleted TEMP=/tmp/nix-shell.deleted
+export NIX_BUILD_TOP=/tmp/nix-shell.deleted TCORE_TEST_VAR=nix
+[ -n "$TCORE_TEST_HANG" ] && sleep 30
+echo shell hook output
+sh -c "$2"
+''')
+
+        # Replaces Nix profile script
+        self.nix_source = self.tmp_dir + '/nix.sh'
+        with open(self.nix_source, 'w') as fl:
+            fl.write('export PATH={}:$PATH\n'.format(bin_dir))
+
+        self.old_nix_source = tcore.NIX_SOURCE_FILE
+        tcore.NIX_SOURCE_FILE = self.nix_source
+
+    def tearDown(self):
+        tcore.NIX_SOURCE_FILE = self.old_nix_source
+        shutil.rmtree(self.tmp_dir)
+
+    def test_temp_dirs_are_not_captured(self):
+        env = tcore.capture_nix_shell_env()
+
+        self.assertEqual(env['TCORE_TEST_VAR'], 'nix')
+        self.assertNotIn('NIX_BUILD_TOP', env)
+        for name in [ 'TMPDIR', 'TEMPDIR', 'TMP', 'TEMP' ]:
+            self.assertEqual(env.get(name), os.environ.get(name))
+
+    def test_temp_dirs_are_restored(self):
+        old_tmpdir = os.environ.get('TMPDIR')
+        os.environ['TMPDIR'] = self.tmp_dir
+
+        try:
+            env = tcore.capture_nix_shell_env()
+        finally:
+            if old_tmpdir is None:
+                os.environ.pop('TMPDIR')
+            else:
+                os.environ['TMPDIR'] = old_tmpdir
+
+        self.assertEqual(env['TMPDIR'], self.tmp_dir)
+
+    def test_timeout(self):
+        old_timeout = tcore.command_timeout
+        tcore.command_timeout = 1
+        os.environ['TCORE_TEST_HANG'] = '1'
+        start = time.monotonic()
+
+        try:
+            with self.assertRaises(SystemExit):
+                tcore.capture_nix_shell_env()
+        finally:
+            tcore.command_timeout = old_timeout
+            os.environ.pop('TCORE_TEST_HANG')
+
+        self.assertLess(time.monotonic() - start, 10)
+
+class test_ccache_env(unittest.TestCase):
+    def setUp(self):
+        self.old_core_src_dir = tcore.core_src_dir
+
+    def tearDown(self):
+        tcore.core_src_dir = self.old_core_src_dir
+
+    def test_base_dir_covers_project_and_core(self):
+        home = os.path.expanduser('~')
+        tcore.core_src_dir = home + '/.theCore/theCore/'
+        env = tcore.get_ccache_env({ 'PATH': '/bin' }, home + '/projects/app', '/tmp/ccache')
+
+        self.assertEqual(env['PATH'], '/bin')
+        self.assertEqual(env['CCACHE_DIR'], '/tmp/ccache')
+        self.assertEqual(env['CCACHE_NOHASHDIR'], '1')
+        self.assertEqual(env['CCACHE_BASEDIR'], home)
+
+    def test_base_dir_is_never_root(self):
+        tcore.core_src_dir = '/opt/theCore/'
+        env = tcore.get_ccache_env({}, '/work/app', '/tmp/ccache')
+
+        self.assertEqual(env['CCACHE_BASEDIR'], '/work/app')
+
+class test_artifacts_index(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.builds_dir = self.tmp_dir + '/build'
+        self.metafile = self.tmp_dir + '/meta.json'
+
+        with open(self.metafile, 'w') as fl:
+            json.dump({ 'targets': { 'b1': { 'debuggers': { 'openocd': {} } }, 'b2': {} } }, fl)
+
+        for target in [ 'b1', 'b2' ]:
+            os.makedirs(self.builds_dir + '/' + target)
+            with open(self.builds_dir + '/' + target + '/app.bin', 'wb') as fl:
+                fl.write(b'\0' * 16)
+
+            tcore.update_artifacts_index(self.builds_dir, self.metafile,
+                { self.builds_dir + '/' + target:
+                    tcore.collect_artifacts(self.builds_dir + '/' + target, target) })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_index_lists_all_targets(self):
+        index = tcore.load_artifacts_index(self.builds_dir, self.metafile)
+
+        self.assertEqual(sorted(a['target'] for a in index['artifacts']), [ 'b1', 'b2' ])
+        self.assertEqual(index['targets']['b1']['debuggers'], { 'openocd': {} })
+
+    def test_deleted_build_dir_is_skipped(self):
+        shutil.rmtree(self.builds_dir + '/b2')
+        index = tcore.load_artifacts_index(self.builds_dir, self.metafile)
+
+        self.assertEqual([ a['target'] for a in index['artifacts'] ], [ 'b1' ])
+
+    def test_changed_metafile_invalidates_index(self):
+        os.utime(self.metafile, (0, 0))
+        self.assertIsNone(tcore.load_artifacts_index(self.builds_dir, self.metafile))
+
+        # Index rebuilt by any target is valid for all of them
+        tcore.update_artifacts_index(self.builds_dir, self.metafile, {})
+        index = tcore.load_artifacts_index(self.builds_dir, self.metafile)
+        self.assertEqual(len(index['artifacts']), 2)
+
+# Fake OpenOCD TCL server. Commands are evaluated by a real Tcl interpreter,
+# OpenOCD commands are replaced by stubs.
+class fake_tcl_server:
+    def __init__(self, image_matches = True, flash_error = None):
+        self.image_matches = image_matches
+        self.flash_error = flash_error
+        self.commands = []
+
+        self.sock = socket.socket()
+        self.sock.bind(('localhost', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+
+        self.thread = threading.Thread(target = self.serve, daemon = True)
+        self.thread.start()
+
+    def serve(self):
+        # Tcl interpreter must be used by the thread it is created in
+        tcl = tkinter.Tcl()
+        tcl.createcommand('reset', lambda *args: self.commands.append(('reset',) + args))
+        tcl.createcommand('record_flash', lambda *args: self.commands.append(('flash',) + args))
+        tcl.eval('proc flash {args} { record_flash {*}$args; if {$::flash_error ne ""} { error $::flash_error } }')
+        tcl.setvar('flash_error', self.flash_error or '')
+        tcl.createcommand('echo', lambda *args: None)
+        tcl.createcommand('verify_image', self.verify_image)
+
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+
+            request = b''
+            with conn:
+                while True:
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        break
+
+                    request += chunk
+                    while b'\x1a' in request:
+                        cmd, request = request.split(b'\x1a', 1)
+                        conn.sendall(tcl.eval(cmd.decode()).encode() + b'\x1a')
+
+    def verify_image(self, *args):
+        self.commands.append(('verify_image',) + args)
+        if not self.image_matches:
+            raise RuntimeError('checksum mismatch')
+
+    def close(self):
+        self.sock.close()
+
+@unittest.skipUnless(tkinter, 'Tcl interpreter is required')
+class test_tcl_client(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_tcl_server()
+        self.client = tcore.openocd_tcl_client(self.server.port, timeout = 5)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_ok(self):
+        self.assertEqual(self.client.checked_command('reset halt; set _ done'), ('done', None))
+        self.assertEqual(self.server.commands, [ ('reset', 'halt') ])
+
+    def test_error(self):
+        result, error = self.client.checked_command('reset halt; error {no flash bank}; reset run')
+
+        self.assertEqual(error, 'no flash bank')
+        # Commands after the failed one are not executed
+        self.assertEqual(self.server.commands, [ ('reset', 'halt') ])
+
+    def test_error_without_message(self):
+        self.assertEqual(self.client.checked_command('error {}'), ('', 'unknown error'))
+
+# Captures tcore log messages
+class log_capture(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+@unittest.skipUnless(tkinter, 'Tcl interpreter is required')
+class test_flash_via_server(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_cwd = os.getcwd()
+        self.old_debugserver_dir = tcore.DEBUGSERVER_DIR
+        self.old_metafile_defaults = tcore.get_metafile.__defaults__
+
+        meta = { 'targets': { 'b1': { 'config': 'b1.json', 'toolchain': 'arm.cmake',
+            'debuggers': { 'openocd': { 'cfg1': { 'file': 'x.cfg', 'flash_address': '0x08000000' } } } } } }
+        with open(self.tmp_dir + '/meta.json', 'w') as fl:
+            json.dump(meta, fl)
+
+        os.makedirs(self.tmp_dir + '/build/b1')
+        with open(self.tmp_dir + '/build/b1/output.json', 'w') as fl:
+            json.dump({ 'meta': self.tmp_dir + '/meta.json', 'target': 'b1' }, fl)
+        with open(self.tmp_dir + '/build/b1/app.bin', 'wb') as fl:
+            fl.write(b'\0' * 16)
+
+        tcore.DEBUGSERVER_DIR = self.tmp_dir + '/debugservers/'
+        os.makedirs(tcore.DEBUGSERVER_DIR)
+        os.chdir(self.tmp_dir)
+        # Metafile is looked up in the directory tcore is started in
+        tcore.get_metafile.__defaults__ = (self.tmp_dir,)
+
+        self.log = log_capture()
+        tcore.logger.addHandler(self.log)
+
+    def tearDown(self):
+        tcore.logger.removeHandler(self.log)
+        os.chdir(self.old_cwd)
+        tcore.get_metafile.__defaults__ = self.old_metafile_defaults
+        tcore.DEBUGSERVER_DIR = self.old_debugserver_dir
+        shutil.rmtree(self.tmp_dir)
+
+    # Flashes through the fake server, returns status from the summary
+    def flash(self, server, *flash_args):
+        with open(tcore.DEBUGSERVER_DIR + 'default.json', 'w') as fl:
+            json.dump({ 'pid': os.getpid(), 'probe': None, 'tcl_port': server.port }, fl)
+
+        try:
+            tcore.do_flash(tcore.parser.parse_args([ 'flash', '--server' ] + list(flash_args)))
+        except SystemExit as e:
+            self.assertEqual(e.code, 1)
+
+        summary = [ m for m in self.log.messages if m.startswith('flash summary') ][-1]
+        for status in [ 'UNCHANGED', 'FAILED', 'OK' ]:
+            if status in summary:
+                return status
+
+    def test_flash(self):
+        server = fake_tcl_server()
+        self.addCleanup(server.close)
+
+        self.assertEqual(self.flash(server), 'OK')
+        self.assertIn(('flash', 'write_image', 'erase', self.tmp_dir + '/build/b1/app.bin',
+            '0x08000000'), server.commands)
+        self.assertEqual(server.commands[-1], ('reset', 'run'))
+
+    def test_skip_if_same(self):
+        server = fake_tcl_server(image_matches = True)
+        self.addCleanup(server.close)
+
+        self.assertEqual(self.flash(server, '--skip-if-same'), 'UNCHANGED')
+        self.assertFalse([ c for c in server.commands if c[0] == 'flash' ])
+
+    def test_skip_if_same_mismatch(self):
+        server = fake_tcl_server(image_matches = False)
+        self.addCleanup(server.close)
+
+        self.assertEqual(self.flash(server, '--skip-if-same'), 'OK')
+        self.assertTrue([ c for c in server.commands if c[0] == 'flash' ])
+
+    def test_error(self):
+        server = fake_tcl_server(flash_error = 'flash bank not found')
+        self.addCleanup(server.close)
+
+        self.assertEqual(self.flash(server), 'FAILED')
+        self.assertIn('flash via debug server failed: flash bank not found', self.log.messages)
+
+# Runs git with fixed identity and local file protocol allowed for submodules
+def git(*args, cwd = None):
+    env = dict(os.environ, GIT_AUTHOR_NAME = 'test', GIT_AUTHOR_EMAIL = 'test@test',
+        GIT_COMMITTER_NAME = 'test', GIT_COMMITTER_EMAIL = 'test@test')
+    return subprocess.check_output([ 'git', '-c', 'protocol.file.allow=always' ] + list(args),
+        cwd = cwd, env = env, stderr = subprocess.STDOUT).decode().strip()
+
+class test_bootstrap(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved = { name: getattr(tcore, name) for name in [ 'CORE_SRC_DIR', 'CORE_INSTALLFILE',
+            'NIX_DIR', 'NIX_SOURCE_FILE', 'NIX_ENV_CACHE_DIR', 'CORE_MIRROR_DIR', 'core_src_dir' ] }
+        self.saved_environ = dict(os.environ)
+
+        # Bare upstream of theCore with a single submodule
+        for name in [ 'sub', 'core' ]:
+            work = self.tmp_dir + '/' + name
+            git('init', '-q', work)
+            with open(work + '/README', 'w') as fl:
+                fl.write(name + '\n')
+            git('add', 'README', cwd = work)
+
+            if name == 'core':
+                git('submodule', '-q', 'add', 'file://' + self.tmp_dir + '/sub.git', 'thirdparty/sub',
+                    cwd = work)
+
+            git('commit', '-q', '-m', name, cwd = work)
+            git('tag', 'v1.0', cwd = work)
+            # Second commit, to check that history is shallow
+            git('commit', '-q', '--allow-empty', '-m', 'next', cwd = work)
+            git('clone', '-q', '--bare', work, self.tmp_dir + '/' + name + '.git')
+
+        self.remote = 'file://' + self.tmp_dir + '/core.git'
+
+        bin_dir = self.tmp_dir + '/bin'
+        os.makedirs(bin_dir)
+        os.makedirs(self.tmp_dir + '/nix')
+
+        # Interrupts submodules download while the flag file exists
+        self.interrupt_flag = self.tmp_dir + '/interrupt'
+        write_script(bin_dir + '/git', '#!/bin/sh\n'
+            + 'if [ -f {} ] && [ "$1" = "submodule" ] && [ "$2" = "update" ]; then\n'.format(
+                self.interrupt_flag)
+            + '    echo interrupted >&2; exit 130\n'
+            + 'fi\n'
+            + 'exec {} "$@"\n'.format(shutil.which('git')))
+        write_script(bin_dir + '/nix-shell', '#!/bin/sh\n'
+            + 'while [ "$1" != "--run" ]; do shift; done\n'
+            + 'sh -c "$2"\n')
+
+        tcore.NIX_DIR = self.tmp_dir + '/nix'
+        tcore.NIX_SOURCE_FILE = self.tmp_dir + '/nix.sh'
+        with open(tcore.NIX_SOURCE_FILE, 'w') as fl:
+            fl.write('export PATH={}:$PATH\n'.format(bin_dir))
+
+        install_dir = self.tmp_dir + '/theCore_home/'
+        tcore.CORE_SRC_DIR = tcore.core_src_dir = install_dir + 'theCore/'
+        tcore.CORE_INSTALLFILE = install_dir + 'installfile.json'
+        tcore.NIX_ENV_CACHE_DIR = install_dir + 'envcache/'
+        tcore.CORE_MIRROR_DIR = install_dir + 'mirrors/objects.git'
+
+        # Submodules are cloned using local file protocol
+        os.environ.update(GIT_CONFIG_COUNT = '1', GIT_CONFIG_KEY_0 = 'protocol.file.allow',
+            GIT_CONFIG_VALUE_0 = 'always')
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(tcore, name, value)
+
+        os.environ.clear()
+        os.environ.update(self.saved_environ)
+        shutil.rmtree(self.tmp_dir)
+
+    def bootstrap(self):
+        tcore.do_bootstrap(tcore.parser.parse_args([ 'bootstrap', '--remote', self.remote,
+            '--depth', '1', '--jobs', '2' ]))
+
+    def test_interrupted_bootstrap_is_resumed(self):
+        src_dir = tcore.CORE_SRC_DIR
+
+        open(self.interrupt_flag, 'w').close()
+        with self.assertRaises(SystemExit):
+            self.bootstrap()
+
+        # Clone is completed, submodules are not
+        self.assertFalse(tcore.theCore_installed())
+        self.assertTrue(os.path.isfile(src_dir + 'README'))
+        self.assertFalse(os.path.isfile(src_dir + 'thirdparty/sub/README'))
+
+        # Marks the clone, to check that it is not re-created
+        marker = src_dir + '.git/tcore-test-marker'
+        open(marker, 'w').close()
+
+        os.remove(self.interrupt_flag)
+        with self.assertLogs(tcore.logger, 'WARNING') as logs:
+            self.bootstrap()
+
+        # Clone options can't be applied to existing clone
+        self.assertTrue([ m for m in logs.output if '--depth and --filter' in m ])
+
+        self.assertTrue(tcore.theCore_installed())
+        self.assertTrue(os.path.isfile(marker))
+        self.assertTrue(os.path.isfile(src_dir + 'thirdparty/sub/README'))
+
+        # History is shallow, both for theCore and its submodule
+        for path in [ src_dir, src_dir + 'thirdparty/sub' ]:
+            self.assertEqual(git('rev-parse', '--is-shallow-repository', cwd = path), 'true')
+            self.assertEqual(git('rev-list', '--count', 'HEAD', cwd = path), '1')
+
+if __name__ == '__main__':
+    unittest.main()